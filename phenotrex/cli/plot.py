@@ -45,7 +45,7 @@ def cccv(inputs, out, title):
               help='The number of top most important features (by absolute SHAP value) to plot.')
 @click.option('--n_samples', default='auto',
               help='The nsamples parameter of SHAP. '
-                   'Only used by models which utilize a `shap.KernelExplainer` (e.g. TrexSVM).')
+                   'Only used by models which utilize a `shap.KernelExplainer`.')
 @click.option('--title', type=str, default='', help='Plot title.')
 @click.option('--verb', is_flag=True)
 def shap_summary(out_plot, out_summary, n_max_features, title, **kwargs):
@@ -78,7 +78,7 @@ def shap_summary(out_plot, out_summary, n_max_features, title, **kwargs):
               help='The number of top most important features (by absolute SHAP value) to plot.')
 @click.option('--n_samples', default='auto',
               help='The nsamples parameter of SHAP. '
-                   'Only used by models which utilize a `shap.KernelExplainer` (e.g. TrexSVM).')
+                   'Only used by models which utilize a `shap.KernelExplainer`.')
 @click.option('--verb', is_flag=True)
 def shap_force(out_prefix, out_summary, n_max_features, **kwargs):
     """
@@ -121,7 +121,7 @@ def shap_force(out_prefix, out_summary, n_max_features, **kwargs):
               help='The number of top most important features (by absolute SHAP value) to plot.')
 @click.option('--n_samples', default='auto',
               help='The nsamples parameter of SHAP. '
-                   'Only used by models which utilize a `shap.KernelExplainer` (e.g. TrexSVM).')
+                   'Only used by models which utilize a `shap.KernelExplainer`.')
 @click.option('--verb', is_flag=True)
 def shap_full(
     force_plot_prefix,
@@ -22,7 +22,7 @@ from phenotrex.cli.generic_opt import common_deepnog_options
                    'Also used to constrain the complexity of SHAP computations with TrexSVMs.')
 @click.option('--shap_n_samples', type=str, default=16000,
               help='The nsamples parameter of SHAP. Only used by models '
-                   'which utilize a `shap.KernelExplainer` (e.g. TrexSVM).')
+                   'which utilize a `shap.KernelExplainer`.')
 @click.option('--verb', is_flag=True)
 @common_deepnog_options
 def predict(*args, **kwargs):
@@ -3,18 +3,27 @@
 #
 from typing import List, Dict, Tuple, Optional
 from collections import Counter
+from functools import lru_cache
+import hashlib
+import inspect
 import json
 import gzip
+import os
+import sys
 
 import pandas as pd
+from joblib import Memory
 from Bio import SeqIO
 from Bio.Alphabet import IUPAC, HasStopCodon, _verify_alphabet
 import numpy as np
 
+import phenotrex
+from phenotrex.structure import records
 from phenotrex.util.logging import get_logger
 from phenotrex.structure.records import GenotypeRecord, PhenotypeRecord, GroupRecord, TrainingRecord
 
 DEFAULT_TRAIT_SIGN_MAPPING = {"YES": 1, "NO": 0}
+CACHE_DIR_ENV_VAR = 'PHENOTREX_CACHE'
 
 
 def _is_gzipped(f: str) -> bool:
@@ -54,32 +63,36 @@ def load_fasta_file(input_file: str) -> Tuple[str, List]:
 
 def load_genotype_file(input_file: str) -> List[GenotypeRecord]:
     """
-    Loads a genotype .tsv file and returns a list of GenotypeRecord for each entry.
+    Loads a (possibly gzipped) genotype .tsv file and returns a list of GenotypeRecord
+    for each entry.
 
     :param input_file: The path to the input genotype file.
     :return: List[GenotypeRecord] of records in the genotype file
     """
-    with open(input_file) as genotype_file:
-        metadata = dict()
-        genotype_lines = []
-        genotype_records = []
+    if _is_gzipped(input_file):
+        openfunc = gzip.open
+        bit = 'rt'
+    else:
+        openfunc = open
+        bit = 'r'
+    # split entries in a single pass; metadata lines may occur anywhere in the file,
+    # so the records are only created once the feature type is known.
+    metadata = {'feature_type': 'legacy'}
+    entries = []
+    with openfunc(input_file, bit) as genotype_file:
         for line in genotype_file:
-            if line.strip().startswith('#'):
-                k, v = line[1:].strip().split(':', maxsplit=1)
+            line = line.strip()
+            if line.startswith('#'):
+                k, v = line[1:].split(':', maxsplit=1)
                 metadata[k] = v
             else:
-                genotype_lines.append(line)
+                identifier, *features = line.split("\t")
+                entries.append((identifier, features))
 
-        metadata = {**{'feature_type': 'legacy'}, **metadata}
-
-        for line in genotype_lines:
-            identifier, *features = line.strip().split("\t")
-            genotype_records.append(
-                GenotypeRecord(
-                    identifier=identifier,
-                    feature_type=metadata['feature_type'],
-                    features=features
-                ))
+    genotype_records = [
+        GenotypeRecord(identifier=identifier, feature_type=metadata['feature_type'], features=features)
+        for identifier, features in entries
+    ]
 
     dupcount = Counter([x.identifier for x in genotype_records])
     if dupcount.most_common()[0][1] > 1:
@@ -290,7 +303,10 @@ def load_training_files(
 ]:
     """
     Convenience function to load phenotype, genotype and optionally groups file together,
-    and return a list of TrainingRecord.
+    and return a list of TrainingRecord. If the environment variable PHENOTREX_CACHE is set,
+    the loaded records are cached on disk in that directory and reused for unchanged files.
+    Records grouped by taxonomic rank are never cached, as the grouping depends on the
+    external NCBI taxonomy database.
 
     :param genotype_file: The path to the input genotype file.
     :param phenotype_file: The path to the input phenotype file.
@@ -299,6 +315,53 @@ def load_training_files(
     :param verb: toggle verbosity.
     :return: The collated TrainingRecords as well as single genotype, phenotype and group records
     """
+    # if a cache directory is configured, reuse the parsed records of unchanged input files
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    if not cache_dir or selected_rank is not None:
+        return _load_training_files(
+            genotype_file, phenotype_file, groups_file, selected_rank, verb=verb
+        )
+    memory = Memory(location=cache_dir, verbose=0)
+    load = memory.cache(_load_training_files_stamped, ignore=['verb'])
+    return load(
+        _file_stamp(genotype_file), _file_stamp(phenotype_file), _file_stamp(groups_file),
+        _parser_version(), verb=verb
+    )
+
+
+@lru_cache(maxsize=None)
+def _parser_version() -> str:
+    """
+    Fingerprint the phenotrex version and the source code of this module and of the records
+    module, so that cached records are invalidated whenever the parsing code changes.
+    joblib.Memory only fingerprints the source of the cached function itself.
+    """
+    sources = [inspect.getsource(sys.modules[__name__]), inspect.getsource(records)]
+    digest = hashlib.sha256('\n'.join(sources).encode()).hexdigest()
+    return f'{phenotrex.__version__}-{digest}'
+
+
+def _file_stamp(input_file: Optional[str]) -> Optional[Tuple[str, int, int]]:
+    """
+    Identify a file by its absolute path, modification time and size, so that cached results
+    derived from it are invalidated when it changes.
+    """
+    if not input_file:
+        return None
+    stat = os.stat(input_file)
+    return os.path.abspath(input_file), stat.st_mtime_ns, stat.st_size
+
+
+def _load_training_files_stamped(
+    genotype_stamp, phenotype_stamp, groups_stamp, parser_version, verb=False
+):
+    return _load_training_files(
+        genotype_stamp[0], phenotype_stamp[0], groups_stamp[0] if groups_stamp else None,
+        selected_rank=None, verb=verb
+    )
+
+
+def _load_training_files(genotype_file, phenotype_file, groups_file, selected_rank, verb=False):
     logger = get_logger(__name__, verb=verb)
     gr = load_genotype_file(genotype_file)
     pr = load_phenotype_file(phenotype_file)
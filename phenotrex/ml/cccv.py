@@ -153,7 +153,8 @@ class CompleContaCV:
                 training_records,
                 classifier,
                 n_features=self.n_features,
-                random_state=self.random_state
+                random_state=self.random_state,
+                n_jobs=1 if self.n_jobs is not None else -1  # no nested parallelism in workers
             )
 
         X_train, y_train, tn, ft = get_x_y_tn_ft(training_records)
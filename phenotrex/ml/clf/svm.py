@@ -5,7 +5,6 @@
 from typing import Dict, List, Tuple, Optional
 
 import numpy as np
-import shap
 
 from sklearn.pipeline import Pipeline
 from sklearn.svm import LinearSVC
@@ -16,10 +15,52 @@ from phenotrex.structure.records import TrainingRecord, GenotypeRecord
 from phenotrex.util.logging import get_logger
 
 KMEANS_N_CLUSTERS = 10
+SHAP_EXPLAINER_DEFAULT = 'linear'
 SHAP_NSAMPLE_DEFAULT = 'auto'
 SHAP_TRACTABLE_N_FEATURES = 7500  # arbitrary threshold after which users are warned that this may take forever
 
 
+def _median_calibrated_coef(clf: CalibratedClassifierCV) -> np.ndarray:
+    r"""
+    Compute the median `coef\_` over all LinearSVCs of a fitted CalibratedClassifierCV.
+
+    :param clf: a fitted CalibratedClassifierCV of binary LinearSVCs.
+    :return: the median feature weights.
+    """
+    calibrated = clf.calibrated_classifiers_
+    weights = np.empty((len(calibrated), calibrated[0].base_estimator.coef_.shape[1]))
+    for i, c in enumerate(calibrated):
+        weights[i] = c.base_estimator.coef_[0]
+    return np.median(weights, axis=0, overwrite_input=True)
+
+
+def _calibrated_logit_model(clf: CalibratedClassifierCV) -> Tuple[np.ndarray, float]:
+    """
+    Approximate a fitted, sigmoid-calibrated CalibratedClassifierCV of LinearSVCs with a single
+    linear model in log-odds space. Each calibrated classifier k predicts the positive class with
+    log-odds -(a_k * (w_k x + c_k) + b_k); the mean of these over all k is again linear in x.
+
+    :param clf: a fitted CalibratedClassifierCV of binary LinearSVCs with method='sigmoid'.
+    :return: the coefficients and intercept of the averaged log-odds model.
+    """
+    calibrated = clf.calibrated_classifiers_
+    coef = np.zeros(calibrated[0].base_estimator.coef_.shape[1])
+    intercept = 0.
+    for c in calibrated:
+        a, b = c.calibrators_[0].a_, c.calibrators_[0].b_
+        coef -= a * c.base_estimator.coef_[0]
+        intercept -= a * c.base_estimator.intercept_[0] + b
+    return coef / len(calibrated), intercept / len(calibrated)
+
+
+def _check_explainer_type(explainer_type: str):
+    """
+    Raise a ValueError if the SHAP explainer type is not supported by TrexSVM.
+    """
+    if explainer_type not in ('linear', 'kernel'):
+        raise ValueError(f'Unknown explainer type: {explainer_type}')
+
+
 class TrexSVM(TrexClassifier):
     """
     Class which encapsulates a sklearn Pipeline of CountVectorizer (for vectorization of features) and
@@ -46,6 +87,8 @@ class TrexSVM(TrexClassifier):
         }
         self.logger = get_logger(__name__, verb=verb)
         self.shap_explainer = None
+        self._coef_cache = None
+        self._coef_cache_clf_id = None
 
         if self.penalty == "l1":
             self.dual = False
@@ -64,12 +107,58 @@ class TrexSVM(TrexClassifier):
             ("clf", classifier)
         ])
 
-    def train(self, records: List[TrainingRecord], train_explainer: bool = True, *args, **kwargs):
+    def train(
+        self,
+        records: List[TrainingRecord],
+        train_explainer: bool = True,
+        explainer_type: str = SHAP_EXPLAINER_DEFAULT,
+        *args, **kwargs
+    ):
+        """
+        Fit CountVectorizer and train LinearSVC on a list of TrainingRecord,
+        and optionally train a SHAP explainer on the training data.
+
+        :param records: a List[TrainingRecord] for fitting of CountVectorizer and training of LinearSVC.
+        :param train_explainer: if True, train a SHAP explainer for the fitted classifier.
+        :param explainer_type: the type of SHAP explainer to train, see fit_explainer().
+        :param kwargs: additional named arguments are passed to TrexClassifier.train().
+        :return: self
+        """
         # must override train method here to append shapexplainer training afterwards.
         # This is not required for XGBoost as XGboost trains a shap model internally per default.
+        _check_explainer_type(explainer_type)
+        self._coef_cache, self._coef_cache_clf_id = None, None
         super().train(records=records, *args, **kwargs)
-        clf = self.pipeline.named_steps['clf']
         if train_explainer:
+            self.fit_explainer(records, explainer_type=explainer_type)
+        return self
+
+    def fit_explainer(
+        self, records: List[TrainingRecord], explainer_type: str = SHAP_EXPLAINER_DEFAULT
+    ):
+        """
+        Train a SHAP explainer for the already fitted classifier, using the records as background.
+
+        :param records: a List[TrainingRecord] to use as background data, usually the training data.
+        :param explainer_type: 'linear' to explain the mean log-odds of the sigmoid-calibrated
+                               LinearSVCs exactly with a shap.LinearExplainer. As
+                               CalibratedClassifierCV averages probabilities rather than log-odds,
+                               these SHAP values only approximate logit(predict_proba).
+                               'kernel' approximates logit(predict_proba) itself with the
+                               model-agnostic (and much slower) shap.KernelExplainer.
+        :return: self
+        """
+        _check_explainer_type(explainer_type)
+        import shap
+        clf = self.pipeline.named_steps['clf']
+        if explainer_type == 'linear':
+            self.logger.info('Training SHAP LinearExplainer.')
+            self.shap_explainer = shap.LinearExplainer(
+                _calibrated_logit_model(clf),
+                self._get_raw_features(records).astype(float),
+                feature_perturbation='interventional',
+            )
+        else:
             # must use k-means to summarize, else intractable at inference time with KernelExplainer
             self.logger.info('Training SHAP KernelExplainer.')
             self.logger.info(f'Running KMeans with k={KMEANS_N_CLUSTERS} on background data...')
@@ -97,8 +186,11 @@ class TrexSVM(TrexClassifier):
         if hasattr(clf, "coef_"):
             return_weights = clf.coef_
         else:  # assume calibrated classifier
-            weights = np.array([c.base_estimator.coef_[0] for c in clf.calibrated_classifiers_])
-            return_weights = np.median(weights, axis=0)
+            # the median over calibrated classifiers is only recomputed if clf has changed
+            if getattr(self, '_coef_cache_clf_id', None) != id(clf):
+                self._coef_cache = _median_calibrated_coef(clf)
+                self._coef_cache_clf_id = id(clf)
+            return_weights = self._coef_cache
         return return_weights
 
     def get_feature_weights(self) -> Dict:
@@ -118,10 +210,9 @@ class TrexSVM(TrexClassifier):
         names = self.pipeline.named_steps["vec"].get_feature_names()
         weights = self._get_coef_()
 
-        # sort by absolute value
-        sorted_weights = {
-            f: w for f, w in sorted(zip(names, weights), key=lambda kv: abs(kv[1]), reverse=True)
-        }
+        # sort by absolute value; stable to keep ties in vocabulary order, as sorted() did
+        order = np.argsort(-np.abs(weights), kind='stable')
+        sorted_weights = {names[i]: weights[i] for i in order}
 
         return sorted_weights
 
@@ -132,12 +223,18 @@ class TrexSVM(TrexClassifier):
         if self.shap_explainer is None:
             self.logger.error('Cannot create shap values: no Shap explainer trained.')
             return None
+        import shap
+        raw_feats = self._get_raw_features(records).astype(int)  # numpy error if using bools
+        if not isinstance(self.shap_explainer, shap.KernelExplainer):
+            self.logger.info('Computing SHAP values for input with LinearExplainer.')
+            shap_values = self.shap_explainer.shap_values(raw_feats)
+            return raw_feats, shap_values, self.shap_explainer.expected_value
+
         if n_samples is None:
             n_samples = SHAP_NSAMPLE_DEFAULT
         if isinstance(n_samples, str) and n_samples.isnumeric():
             n_samples = int(n_samples)
         self.logger.info(f'Computing SHAP values for input using n_samples={n_samples}.')
-        raw_feats = self._get_raw_features(records).astype(int)  # numpy error if using bools
         if raw_feats.shape[1] > SHAP_TRACTABLE_N_FEATURES:
             too_expensive = f"Attempting to compute SHAP explanation with KernelExplainer and " \
                             f"n_features={raw_feats.shape[1]}. This may take a _very_ long time."
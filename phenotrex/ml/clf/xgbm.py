@@ -12,12 +12,24 @@ from phenotrex.util.logging import get_logger
 from phenotrex.structure.records import GenotypeRecord
 
 
+def _gpu_requested() -> bool:
+    """
+    Whether GPU training of XGBoost models was requested by setting the environment variable
+    XGB_USE_GPU. This is opt-in only: xgboost wheels are built with CUDA support regardless of
+    whether a GPU is present, so a CUDA-enabled build does not imply a usable GPU.
+    """
+    return os.environ.get('XGB_USE_GPU', '').lower() in ('1', 'true', 'yes')
+
+
 class TrexXGB(TrexClassifier):
     """
     Class which encapsulates a sklearn Pipeline of CountVectorizer (for vectorization of features) and
     xgb.sklearn.GradientBoostingClassifier.
     Provides train() and crossvalidate() functionality equivalent to train.py and crossvalidateMT.py.
 
+    If the environment variable XGB_USE_GPU is set to 1, trees are built on the GPU with
+    tree_method='gpu_hist', unless a tree_method is passed explicitly.
+
     :param random_state: A integer randomness seed for a Mersienne Twister (see np.random.RandomState)
     :param kwargs: Any additional named arguments are passed to the XGBClassifier constructor.
     """
@@ -45,6 +57,10 @@ class TrexXGB(TrexClassifier):
             'eval_metric'     : ['auc', 'aucpr']
         }
 
+        if _gpu_requested() and 'tree_method' not in kwargs:
+            self.logger.info('XGB_USE_GPU is set, training on GPU.')
+            kwargs['tree_method'] = 'gpu_hist'
+
         classifier = xgb.sklearn.XGBClassifier(
             missing=0,
             max_depth=max_depth,
@@ -20,7 +20,8 @@ def recursive_feature_elimination(
     pipeline: Pipeline,
     step: float = DEFAULT_STEP_SIZE,
     n_features: int = None,
-    random_state: np.random.RandomState = None
+    random_state: np.random.RandomState = None,
+    n_jobs: int = -1
 ):
     """
     Function to apply RFE to limit the vocabulary used by the CustomVectorizer, optional step.
@@ -30,6 +31,8 @@ def recursive_feature_elimination(
     :param step: rate of features to eliminate at each step. the lower the number, the more steps
     :param n_features: number of features to select (if None: half of the provided features)
     :param random_state: random state for deterministic results
+    :param n_jobs: number of parallel jobs used to evaluate the cross-validation folds
+                   (-1 for n_cpus)
     :return: number of features used
     """
     t1 = time()
@@ -38,15 +41,16 @@ def recursive_feature_elimination(
     vec = pipeline.named_steps["vec"]
     estimator = pipeline.named_steps["clf"]
 
+    # tokenize the records only once, whether or not the vocabulary still needs to be learned
     if not vec.vocabulary:
-        vec.fit(X)
+        X_trans = vec.fit_transform(X)
+    else:
+        X_trans = vec.transform(X)
     previous_vocabulary = vec.vocabulary_
 
     if not n_features:
         n_features = len(previous_vocabulary) // 2
 
-    X_trans = vec.transform(X)
-
     logger = get_logger(__name__, verb=True)
     split = StratifiedKFold(shuffle=True, n_splits=5, random_state=random_state)
     selector = RFECV(
@@ -54,19 +58,20 @@ def recursive_feature_elimination(
         step=step,
         min_features_to_select=n_features,
         cv=split,
-        n_jobs=5,
+        n_jobs=n_jobs,
         scoring=DEFAULT_SCORING_FUNCTION
     )
     selector = selector.fit(X=X_trans, y=y)
 
     original_size = len(previous_vocabulary)
     support = selector.get_support()
-    support = support.nonzero()[0]
-    new_id = {support[x]: x for x in range(len(support))}
+    # map old feature indices to their index among the selected features; -1 if eliminated
+    new_id = np.full(len(support), -1, dtype=np.intp)
+    new_id[support] = np.arange(np.count_nonzero(support))
     vocabulary = {
-        feature: new_id[i]
+        feature: int(new_id[i])
         for feature, i in previous_vocabulary.items()
-        if new_id.get(i) is not None
+        if new_id[i] >= 0
     }
     size_after = selector.n_features_
 
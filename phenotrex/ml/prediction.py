@@ -4,6 +4,7 @@ import pandas as pd
 from phenotrex.io.flat import load_genotype_file, DEFAULT_TRAIT_SIGN_MAPPING
 from phenotrex.io.serialization import load_classifier
 from phenotrex.ml.shap_handler import ShapHandler
+from phenotrex.ml.trex_classifier import TrexClassifier
 
 try:
     from phenotrex.transforms import fastas_to_grs
@@ -26,19 +27,21 @@ def predict(
     """
     Predict phenotype from a set of (possibly gzipped) DNA or protein FASTA files
     or a single genotype file. Optionally, compute SHAP explanations individually and/or summarily
-    for the predicted samples.
+    for the predicted samples. All inputs are predicted in a single batch.
 
     NB: Genotype computation is highly expensive and performed on the fly on FASTA files.
     For increased speed when predicting multiple phenotypes, create a .genotype file to reuse
     with the command `compute-genotype`.
 
-    NB: As opposed to XGB models where they are trivially available, computing SHAP explanations
-    on SVM models entails training a model-agnostic KernelExplainer which is highly costly (dozens
-    to hundreds of seconds per sample if using a somewhat reasonable value for `shap_n_samples`).
+    NB: SHAP explanations of XGB models and of SVM models trained with a LinearExplainer
+    (the default) are cheap to compute. SVM models trained with a model-agnostic KernelExplainer
+    are highly costly to explain (dozens to hundreds of seconds per sample if using a somewhat
+    reasonable value for `shap_n_samples`).
 
-    :param fasta_files: An iterable of fasta file paths
+    :param fasta_files: An iterable of fasta file paths, each of which is predicted as one sample.
     :param genotype: A genotype file path
-    :param classifier: A pickled classifier file path
+    :param classifier: A pickled classifier file path, or an already loaded TrexClassifier
+                       to avoid unpickling it again for repeated predictions.
     :param min_proba: Confidence threshold of the phenotrex prediction below which
                       predictions will be masked by 'N/A'.
     :param out_explain_per_sample: Where to save the most influential features by SHAP for each
@@ -50,6 +53,7 @@ def predict(
     :param deepnog_threshold: Confidence threshold of deepnog annotations below which annotations
                               will be discarded.
     :param verb: Whether to show progress of fasta file annotation.
+    :return: A DataFrame of the printed predictions, with one row per predicted sample.
     """
     if not len(fasta_files) and genotype is None:
         raise RuntimeError('Must supply FASTA file(s) and/or single genotype file for prediction.')
@@ -63,7 +67,10 @@ def predict(
     grs_from_file = load_genotype_file(genotype) if genotype is not None else []
     gr = grs_from_fasta + grs_from_file
 
-    model = load_classifier(filename=classifier, verb=verb)
+    if isinstance(classifier, TrexClassifier):
+        model = classifier
+    else:
+        model = load_classifier(filename=classifier, verb=verb)
     if out_explain_per_sample is not None or out_explain_summary is not None:
         try:
             fs, sv, bv = model.get_shap(
@@ -93,9 +100,12 @@ def predict(
     }
     print(f"# Trait: {model.trait_name}")
     print("Identifier\tTrait present\tConfidence")
+    rows = []
     for record, result, probability in zip(gr, preds, probas):
         if probability[result] < min_proba:
             result_disp = "N/A"
         else:
             result_disp = translate_output[result]
+        rows.append((record.identifier, result_disp, round(probability[result], 4)))
         print(f"{record.identifier}\t{result_disp}\t{str(round(probability[result], 4))}")
+    return pd.DataFrame(rows, columns=['Identifier', 'Trait present', 'Confidence'])
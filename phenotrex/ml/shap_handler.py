@@ -1,13 +1,101 @@
-from typing import Tuple
+from typing import Tuple, TYPE_CHECKING
 
 import pandas as pd
 import numpy as np
-import shap
-from matplotlib import pyplot as plt
+import scipy.sparse as sp
 
 from phenotrex.ml.trex_classifier import TrexClassifier
 from phenotrex.util.external_data import Eggnog5TextAnnotator
 
+if TYPE_CHECKING:  # shap and matplotlib are slow to import; only needed for plotting
+    from matplotlib import pyplot as plt
+
+NUMBA_MIN_SAMPLES = 10000  # below this, compiling the numba kernel costs more than it saves
+
+_present_absent_kernel = None
+
+
+def _get_present_absent_kernel():
+    """
+    Compile (once) and return a numba kernel computing, per feature column, sums and counts of
+    SHAP values where the feature is present and where it is absent. Presence is read from the
+    index structure of a CSC matrix, so no dense presence mask has to be built.
+    numba is an optional dependency; return None if it is not installed.
+    """
+    global _present_absent_kernel
+    if _present_absent_kernel is None:
+        try:
+            from numba import njit, prange
+        except ImportError:
+            return None
+
+        @njit(parallel=True)
+        def kernel(indptr, indices, S):
+            n, k = S.shape
+            sum_p = np.zeros(k)
+            sum_a = np.zeros(k)
+            cnt_p = np.zeros(k, dtype=np.int64)
+            cnt_a = np.zeros(k, dtype=np.int64)
+            for j in prange(k):
+                total = 0.
+                for i in range(n):
+                    total += S[i, j]
+                present_total = 0.
+                for p in range(indptr[j], indptr[j + 1]):
+                    present_total += S[indices[p], j]
+                sum_p[j] = present_total
+                sum_a[j] = total - present_total
+                cnt_p[j] = indptr[j + 1] - indptr[j]
+                cnt_a[j] = n - cnt_p[j]
+            return sum_p, cnt_p, sum_a, cnt_a
+
+        _present_absent_kernel = kernel
+    return _present_absent_kernel
+
+
+def _present_absent_sums(
+    present: sp.spmatrix, shaps: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Per feature, sum up SHAP values of samples in which the feature is present and absent.
+
+    :param present: a sparse boolean matrix of shape (n_samples, n_features)
+                    without explicitly stored zeros.
+    :param shaps: the SHAP values corresponding to `present`.
+    :return: sums and counts of SHAP values where present, sums and counts where absent.
+    """
+    kernel = None
+    if shaps.ndim == 2 and shaps.shape[0] >= NUMBA_MIN_SAMPLES:
+        kernel = _get_present_absent_kernel()
+    if kernel is not None:
+        # the kernel sweeps down columns, so hand it column-major data
+        present = present.tocsc()
+        return kernel(present.indptr, present.indices, np.asfortranarray(shaps))
+    n_present = present.getnnz(axis=0)
+    sum_present = np.asarray(present.multiply(shaps).sum(axis=0, dtype=np.float64)).ravel()
+    sum_absent = shaps.sum(axis=0, dtype=np.float64) - sum_present
+    return sum_present, n_present, sum_absent, present.shape[0] - n_present
+
+
+def _descending_order(criterion: np.ndarray, top_k: int = None) -> np.ndarray:
+    """
+    Get indices sorting `criterion` in descending order, breaking ties by ascending index.
+
+    :param criterion: a 1D array of values to sort by.
+    :param top_k: if passed, only return the indices of the top_k values. These are the
+                  same as the first top_k indices returned without top_k.
+    :return: the sorting indices.
+    """
+    if top_k is None or top_k >= len(criterion):
+        return np.argsort(-criterion, kind='stable')
+    if top_k <= 0:
+        return np.array([], dtype=np.intp)
+    # partition to find the top_k-th largest value, then only sort values at least as large
+    threshold = -np.partition(-criterion, top_k - 1)[top_k - 1]
+    candidates = np.flatnonzero(criterion >= threshold)
+    return candidates[np.argsort(-criterion[candidates], kind='stable')][:top_k]
+
+
 class ShapHandler:
     """
     This class handles feature arrays and shap values of predictions made with phenotrex,
@@ -20,13 +108,18 @@ class ShapHandler:
     @classmethod
     def from_clf(cls, clf: TrexClassifier):
         fn = np.array(clf.pipeline.named_steps["vec"].get_feature_names())
-        used_fn = [k for k, v in clf.get_feature_weights().items() if v != 0]
-        used_idxs = np.where(np.isin(fn, used_fn))[0]
+        name_to_idx = {n: i for i, n in enumerate(fn)}
+        used_idxs = np.fromiter(
+            (name_to_idx[k] for k, v in clf.get_feature_weights().items()
+             if v != 0 and k in name_to_idx),
+            dtype=np.intp
+        )
+        used_idxs.sort()
         feature_type = clf.feature_type
         return cls(fn, used_idxs, feature_type=feature_type)
 
     @staticmethod
-    def _fix_shap_force_figure(fig: plt.Figure) -> plt.Figure:
+    def _fix_shap_force_figure(fig: 'plt.Figure') -> 'plt.Figure':
         """
         Replaces the figure annotation in shap force plots with "absent" if value = 0.0 and
         "present" if value = 1.0.
@@ -34,6 +127,7 @@ class ShapHandler:
         :param fig: a matplotlib.pyplot.Figure as produced by shap.force_plot.
         :return: The same fig, modified as described.
         """
+        from matplotlib import pyplot as plt
         ax = fig.gca()
         for c in ax.get_children():
             if isinstance(c, plt.Text):
@@ -56,9 +150,15 @@ class ShapHandler:
         else:
             self._text_annotator = None
             self._feature_taxon = None
+        self._sample_name_chunks = []
+        self._feature_chunks = []
+        self._shap_chunks = []
+        self._sample_name_to_idx = {}
         self._sample_names = None
         self._used_features = None
         self._used_shaps = None
+        self._dirty = False
+        self._global_sort_inds = None
         self._shap_base_value = None
         self._class_names = ['YES']
 
@@ -90,85 +190,103 @@ class ShapHandler:
             assert np.allclose(self._shap_base_value, base_value), \
                 f'Incongruent base values found: {self._shap_base_value} vs. {base_value}.'
 
-        X_used = np.nan_to_num(features[:, self._used_idxs])
-        shaps_used = np.nan_to_num(shaps[..., self._used_idxs])
-
-        try:
-            X_used = X_used.toarray()
-        except AttributeError:
-            pass
-
-        if self._sample_names is None:
-            self._sample_names = sample_names
+        # fancy indexing already returns copies, so NaNs may be replaced in place
+        X_used = features[:, self._used_idxs]
+        if sp.issparse(X_used):
+            X_used = X_used.tocsr()
+            np.nan_to_num(X_used.data, copy=False)
         else:
-            self._sample_names = np.concatenate([self._sample_names, sample_names])
+            X_used = np.nan_to_num(X_used, copy=False)
+        # only feature presence is needed, so store features as boolean
+        X_used = sp.csr_matrix(X_used, dtype=bool)
+        X_used.eliminate_zeros()
+        # single precision suffices for storing shaps; reductions accumulate in double precision
+        shaps_used = np.nan_to_num(
+            shaps[..., self._used_idxs].astype(np.float32, copy=False), copy=False
+        )
 
-        if self._used_features is None:
-            self._used_features = X_used
-        else:
-            self._used_features = np.concatenate([self._used_features, X_used])
+        sample_names = np.asarray(sample_names)
+        offset = sum(len(x) for x in self._sample_name_chunks)
+        for i, sample_name in enumerate(sample_names, start=offset):
+            self._sample_name_to_idx.setdefault(sample_name, i)
 
-        if self._used_shaps is None:
-            self._used_shaps = shaps_used
-        else:
-            self._used_shaps = np.concatenate([self._used_shaps, shaps_used])
+        # stash the new chunks; they are concatenated once, lazily, when next accessed
+        self._sample_name_chunks.append(sample_names)
+        self._feature_chunks.append(X_used)
+        self._shap_chunks.append(shaps_used)
+        self._dirty = True
+        self._global_sort_inds = None
+
+    def _consolidate(self):
+        """
+        Concatenate all feature data chunks added since the last call into single arrays.
+        Chunks are replaced by the concatenated arrays, so each added chunk is copied only once
+        per consolidation instead of once per call to `add_feature_data`.
+        Features and shaps are stored column-major (CSC/Fortran order), since summaries
+        reduce over samples separately for each feature.
+        """
+        if not self._dirty:
+            return
+        self._sample_names = np.concatenate(self._sample_name_chunks)
+        self._used_features = sp.vstack(self._feature_chunks, format='csc')
+        self._used_shaps = np.asfortranarray(np.concatenate(self._shap_chunks))
+        self._sample_name_chunks = [self._sample_names]
+        self._feature_chunks = [self._used_features]
+        self._shap_chunks = [self._used_shaps]
+        self._dirty = False
 
     def _get_sample_index_with_name(self, sample_name: str) -> int:
         try:
-            i = np.where(np.isin(self._sample_names, sample_name))[0][0]
-            return i
-        except (ValueError, IndexError):
+            return self._sample_name_to_idx[sample_name]
+        except KeyError:
             raise ValueError('Sample label not found among saved explanations.')
 
-    def _get_feature_data(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    def _get_feature_data(self) -> Tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
         """
         Concatenate and return all currently saved features, shaps and sample names.
 
-        :returns: A tuple of saved used features (the actual values),
-                  the saved shap values corresponding to the features,
+        :returns: A tuple of saved used features (presence as a sparse boolean matrix),
+                  the saved shap values (single precision) corresponding to the features,
                   and the sample names from which features and shap values were derived.
         """
-        try:
-            X_agg = self._used_features.astype(float)
-            shap_agg = self._used_shaps.astype(float)
-        except (ValueError, AttributeError):
+        self._consolidate()
+        if self._used_shaps is None:
             raise RuntimeError('No explanations saved.')
-        sample_names = self._sample_names
-        return X_agg, shap_agg, sample_names
+        return self._used_features, self._used_shaps, self._sample_names
 
     def _get_sorted_by_shap_data(
-        self, sort_by_idx=None
-    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        self, sort_by_idx=None, top_k: int = None
+    ) -> Tuple[sp.csc_matrix, np.ndarray, np.ndarray]:
         """
         Sort features by absolute magnitude of shap values,
         and return sorted features, shap values and feature names.
 
         :param sort_by_idx: if an index into the sample names is passed,
                             sorting will be based only on this sample's SHAP values.
+        :param top_k: if passed, only return data of the top_k features.
         :return: Used features, used shaps, and the feature names
                  all sorted by absolute magnitude of shap value.
         """
         X_agg, shap_agg, _ = self._get_feature_data()
-
-        if shap_agg.ndim == 2:
-            if sort_by_idx is None:
-                feature_sort_inds = np.argsort(np.sum(np.abs(shap_agg), axis=0))[::-1]
-            else:
-                feature_sort_inds = np.argsort(np.abs(shap_agg[sort_by_idx, :]))[::-1]
-        else:
-            feature_axis = shap_agg.ndim - 1
-            nonfeature_axes = list(range(feature_axis))
-            absshap = np.apply_along_axis(np.abs, feature_axis, shap_agg)
-            if sort_by_idx is None:
-                # sort features by absolute change in shap over all classes and samples
-                sort_criterion = np.apply_over_axes(np.sum, absshap, nonfeature_axes)
-            else:  # sort features by absolute change in shap over all classes for given sample idx
-                sort_criterion = np.sum(absshap[sort_by_idx, ...], axis=0)
-            feature_sort_inds = np.squeeze(np.argsort(sort_criterion))[::-1]
+        feature_axis = shap_agg.ndim - 1
+
+        if sort_by_idx is None:
+            # sort features by absolute change in shap over all classes and samples;
+            # the permutation only changes when new feature data is added, so cache it.
+            if self._global_sort_inds is None:
+                nonfeature_axes = tuple(range(feature_axis))
+                sort_criterion = np.abs(shap_agg).sum(axis=nonfeature_axes, dtype=np.float64)
+                self._global_sort_inds = _descending_order(sort_criterion)
+            feature_sort_inds = self._global_sort_inds[:top_k]
+        else:  # sort features by absolute change in shap over all classes for given sample idx
+            sort_criterion = np.abs(shap_agg[sort_by_idx, ...])
+            if feature_axis > 1:
+                sort_criterion = sort_criterion.sum(axis=0)
+            feature_sort_inds = _descending_order(sort_criterion, top_k)
         return (X_agg[:, feature_sort_inds], shap_agg[..., feature_sort_inds],
                 self._used_feature_names[feature_sort_inds])
 
-    def plot_shap_force(self, sample_name: str, n_max_features: int = 20, **kwargs) -> plt.Figure:
+    def plot_shap_force(self, sample_name: str, n_max_features: int = 20, **kwargs) -> 'plt.Figure':
         """
         Create force plot of the sample associated with the given sample name.
 
@@ -177,15 +295,18 @@ class ShapHandler:
         :param kwargs: additional keyword arguments passed on to `shap.force_plot()`
         :return:
         """
+        import shap
         i = self._get_sample_index_with_name(sample_name)
-        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data(sort_by_idx=i)
+        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data(
+            sort_by_idx=i, top_k=n_max_features
+        )
         if n_max_features is None:
             n_max_features = len(feature_names_s)
 
         fig = shap.force_plot(
             base_value=self._shap_base_value,
             shap_values=shap_agg_s[i, :n_max_features],
-            features=X_agg_s[i, :n_max_features],
+            features=X_agg_s[i, :n_max_features].astype(float).toarray().ravel(),
             feature_names=feature_names_s[:n_max_features],
             matplotlib=True,
             show=False,
@@ -210,7 +331,10 @@ class ShapHandler:
         :param kwargs: additional keyword arguments passed on to `shap.summary_plot()`
         :return:
         """
+        import shap
+        from matplotlib import pyplot as plt
         X_agg, shap_agg, _ = self._get_feature_data()
+        X_agg = X_agg.astype(float).toarray()
 
         class_names = self._class_names
         if shap_agg.ndim == 3:
@@ -254,37 +378,35 @@ class ShapHandler:
                  their value in the sample, and the associated SHAP value(s).
         """
         i = self._get_sample_index_with_name(sample_name)
-        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data(sort_by_idx=i)
+        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data(
+            sort_by_idx=i, top_k=n_max_features
+        )
 
         if n_max_features is None:
             n_max_features = len(feature_names_s)
 
         fns = feature_names_s[:n_max_features]
-        feature_vals = X_agg_s[i, :n_max_features]
+        feature_vals = X_agg_s[i, :n_max_features].astype(float).toarray().ravel()
 
         if shap_agg_s.ndim == 3:
             shap_agg_s = np.swapaxes(shap_agg_s, 0, 1)
-            shap_vals = list(shap_agg_s[:, i, :n_max_features].round(5))
+            shap_vals = list(shap_agg_s[:, i, :n_max_features].astype(float).round(5))
         else:
-            shap_vals = [shap_agg_s[i, :n_max_features].round(5), ]
-        sample_names = [sample_name] * len(fns)
-        df_arrs = [sample_names, fns, feature_vals, *shap_vals]
-        df_arrs = [np.array(x) for x in df_arrs]
-        df_labels = [
-            'Sample',
-            'Feature',
-            'Feature Presence',
-            *[f'SHAP Value (class={x})' for x in self._class_names]
-        ][:len(df_arrs)]
-        df = pd.DataFrame(df_arrs, index=df_labels).T
-        df.index.name = 'rank'
+            shap_vals = [shap_agg_s[i, :n_max_features].astype(float).round(5), ]
+        df = pd.DataFrame({
+            'rank': np.arange(len(fns)),
+            'Sample': [sample_name] * len(fns),
+            'Feature': fns,
+            'Feature Presence': feature_vals,
+            **{f'SHAP Value (class={c})': sv for c, sv in zip(self._class_names, shap_vals)},
+        })
         if self._text_annotator is not None:
             annots = df['Feature'].apply(
                 lambda x: self._text_annotator.annotate(self._feature_taxon, x)[1]
             )
             if any(annots):
                 df['Feature Annotation'] = annots
-        return df.reset_index(drop=False)
+        return df
 
     def get_shap_summary(self, n_max_features: int = 50):
         """
@@ -294,24 +416,25 @@ class ShapHandler:
         :param n_max_features:
         :return: a DataFrame of most important SHAP values for samples in the given dataset.
         """
-        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data()
+        X_agg_s, shap_agg_s, feature_names_s = self._get_sorted_by_shap_data(
+            top_k=n_max_features
+        )
         if n_max_features is None:
             n_max_features = len(feature_names_s)
-        columns = ['Feature', 'Mean SHAP If Present', 'Mean SHAP If Absent', 'N(present)', 'N(absent)']
-        lines = []
-        for i in range(n_max_features):
-            feature_name = feature_names_s[i]
-            feature = X_agg_s[:, i]
-            shaps = shap_agg_s[:, i]
-            shaps_where_present = shaps[np.where(feature > 0)[0]]
-            shaps_where_absent = shaps[np.where(feature == 0)[0]]
-            mean_sv_present = np.average(shaps_where_present)
-            mean_sv_absent = np.average(shaps_where_absent)
-            n_where_present = len(shaps_where_present)
-            n_where_absent = len(shaps_where_absent)
-            lines.append([feature_name, mean_sv_present.round(5), mean_sv_absent.round(5),
-                          n_where_present, n_where_absent])
-        sh_df = pd.DataFrame(lines, columns=columns)
+        shaps = shap_agg_s[:, :n_max_features]
+        present = X_agg_s[:, :n_max_features]
+        sum_sv_present, n_where_present, sum_sv_absent, n_where_absent = \
+            _present_absent_sums(present, shaps)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_sv_present = sum_sv_present / n_where_present
+            mean_sv_absent = sum_sv_absent / n_where_absent
+        sh_df = pd.DataFrame({
+            'Feature': feature_names_s[:n_max_features],
+            'Mean SHAP If Present': mean_sv_present.round(5),
+            'Mean SHAP If Absent': mean_sv_absent.round(5),
+            'N(present)': n_where_present,
+            'N(absent)': n_where_absent,
+        })
         if self._text_annotator is not None:
             annots = sh_df['Feature'].apply(
                 lambda x: self._text_annotator.annotate(self._feature_taxon, x)[1]
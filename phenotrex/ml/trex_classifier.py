@@ -7,6 +7,7 @@ import gc
 
 from scipy.sparse import csr_matrix
 import numpy as np
+from joblib import Parallel, delayed
 
 from sklearn.base import clone
 from sklearn.metrics import balanced_accuracy_score, f1_score, precision_score, recall_score
@@ -28,6 +29,28 @@ def specificity_score(y, y_pred, **kwargs) -> float:
     return recall_score(y, y_pred, pos_label=0, **kwargs)
 
 
+def _fit_predict_fold(
+    estimator, X, y, train_index: np.ndarray, test_index: np.ndarray, seed: int = None
+):
+    """
+    Fit a clone of the estimator on the training split of X, y and predict the test split.
+    Defined at module level so it can be dispatched to joblib worker processes.
+
+    Cloning deep-copies any np.random.RandomState passed as `random_state` to the estimator
+    (or nested estimators), which would give every fold an identical random stream.
+    If `seed` is passed, such random states are replaced by this integer seed instead.
+    """
+    est = clone(estimator)
+    if seed is not None:
+        est.set_params(**{
+            k: seed for k, v in est.get_params().items()
+            if (k == 'random_state' or k.endswith('__random_state'))
+            and isinstance(v, np.random.RandomState)
+        })
+    est.fit(X[train_index], y[train_index])
+    return est.predict(X[test_index])
+
+
 class TrexClassifier(ABC):
     """
     Abstract base class of Trex classifier.
@@ -102,7 +125,11 @@ class TrexClassifier(ABC):
         if reduce_features:
             self.logger.info("using recursive feature elimination as feature selection strategy")
             # use non-calibrated classifier
-            recursive_feature_elimination(records, self.cv_pipeline, n_features=n_features)
+            # evaluate folds in parallel, unless the classifier parallelizes internally
+            recursive_feature_elimination(
+                records, self.cv_pipeline, n_features=n_features,
+                n_jobs=1 if self.n_jobs > 1 else -1
+            )
 
         self.trait_name = tn
         self.feature_type = ft
@@ -131,6 +158,20 @@ class TrexClassifier(ABC):
         probas = self.pipeline.predict_proba(X=features)  # class probabilities via Platt scaling
         return preds, probas
 
+    def fit_explainer(self, records: List[TrainingRecord], **kwargs):
+        """
+        Train a SHAP explainer for the already fitted classifier.
+        Classifiers which provide SHAP explanations without an Explainer do nothing here.
+
+        :param records: a List[TrainingRecord] to use as background data, usually the training data.
+        :param kwargs: Unused
+        :return: self
+        """
+        self.logger.info(
+            f'{self.__class__.__name__} provides SHAP explanations without training an Explainer.'
+        )
+        return self
+
     @abstractmethod
     def get_feature_weights(self) -> Dict:
         """
@@ -150,10 +191,10 @@ class TrexClassifier(ABC):
         :param records: A list of TrainingRecords or GenotypeRecords.
         :param n_samples: the n_samples parameter to be passed to the Explainer.
                           Only used if the model in question relies on a
-                          KernelExplainer (e.g. TrexSVM).
+                          KernelExplainer (e.g. TrexSVM with explainer_type='kernel').
         :param n_features: The number of features to consider for Explaining.
                            Only used if the model in question
-                           relies on a KernelExplainer (e.g. TrexSVM).
+                           relies on a KernelExplainer (e.g. TrexSVM with explainer_type='kernel').
         :returns: transformed feature array, computed shap values and expected value.
         """
         pass
@@ -248,6 +289,12 @@ class TrexClassifier(ABC):
         :param demote: toggles logger that is used. if true, msg is written to debug else info
         :param kwargs: Unused
         :return: A list of mean score, score SD, and the percentage of misclassifications per sample
+
+        NB: Folds may be fitted in parallel. Classifiers seeded with the shared random state of
+        this TrexClassifier, as well as the inner splits of recursive feature elimination, receive
+        an integer seed per fold drawn from that random state instead. Results are reproducible
+        for a given `random_state` regardless of `n_jobs`, but differ from those of phenotrex
+        versions fitting folds sequentially.
         """
         if n_jobs != 1 and self.n_jobs > 1:
             self.logger.info(f'Will use selected classifier parallelism instead of multithreading.')
@@ -257,14 +304,11 @@ class TrexClassifier(ABC):
         t1 = time()
         X, y, tn, ft = get_x_y_tn_ft(records)
 
-        # unfortunately RFECV does not work with pipelines (need to use the vectorizer separately)
-        self.cv_pipeline.fit(X, y)
+        # unfortunately RFECV does not work with pipelines (need to use the vectorizer separately).
+        # Only the vectorizer is fitted on the full data; the classifier is fitted per fold.
         vec = self.cv_pipeline.named_steps["vec"]
         clf = self.cv_pipeline.named_steps["clf"]
-
-        if not vec.vocabulary:
-            vec.fit(X)
-        X_trans = vec.transform(X)
+        X_trans = vec.fit_transform(X)
 
         misclassifications = np.zeros(len(y))
         scores = {k: [] for k, _ in self.scoring_function_mapping.items()}
@@ -281,32 +325,37 @@ class TrexClassifier(ABC):
             )
             group_ids = None
 
-        for i in range(n_replicates):
-            inner_cv = StratifiedKFold(
-                n_splits=cv, shuffle=True, random_state=self.random_state
-            )
-            outer_cv = splitting_strategy
-            for tr, ts in outer_cv.split(X_trans, y, groups=group_ids):
+        # folds are evaluated in parallel, unless the classifier or RFECV parallelize internally
+        fold_n_jobs = 1 if reduce_features or self.n_jobs > 1 else n_jobs
+        with Parallel(n_jobs=fold_n_jobs) as parallel:
+            for i in range(n_replicates):
+                folds = list(splitting_strategy.split(X_trans, y, groups=group_ids))
+                # draw fold seeds here, so folds get distinct but reproducible random streams
+                seeds = self.random_state.randint(np.iinfo(np.int32).max, size=len(folds))
                 if reduce_features:
-                    est = RFECV(
+                    # the inner splits of each fold are seeded with the fold's seed as well
+                    ests = [RFECV(
                         estimator=clf,
-                        cv=inner_cv,
+                        cv=StratifiedKFold(n_splits=cv, shuffle=True, random_state=seed),
                         n_jobs=n_jobs,
                         step=DEFAULT_STEP_SIZE,
                         min_features_to_select=n_features,
                         scoring=DEFAULT_SCORING_FUNCTION
-                    )
+                    ) for seed in seeds]
                 else:
-                    est = clf
-                est.fit(X_trans[tr], y[tr])
-                y_pred = est.predict(X_trans[ts])
-                mismatch = np.logical_xor(y[ts], y_pred)
-                mismatch_indices = ts[np.where(mismatch)]
-                misclassifications[mismatch_indices] += 1
-                for score_name, scoring_func in self.scoring_function_mapping.items():
-                    score = scoring_func(y[ts], y_pred)
-                    scores[score_name].append(score)
-            log_function(f"Finished replicate {i + 1} of {n_replicates}")
+                    ests = [clf] * len(folds)
+                y_preds = parallel(
+                    delayed(_fit_predict_fold)(est, X_trans, y, tr, ts, seed)
+                    for (tr, ts), est, seed in zip(folds, ests, seeds)
+                )
+                for (tr, ts), y_pred in zip(folds, y_preds):
+                    misclassifications[ts] += (y[ts] != y_pred).astype(
+                        misclassifications.dtype, copy=False
+                    )
+                    for score_name, scoring_func in self.scoring_function_mapping.items():
+                        score = scoring_func(y[ts], y_pred)
+                        scores[score_name].append(score)
+                log_function(f"Finished replicate {i + 1} of {n_replicates}")
 
         misclassifications /= n_replicates
         score_mean_sd = {}
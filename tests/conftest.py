@@ -0,0 +1,17 @@
+import os
+
+
+def pytest_configure(config):
+    """
+    Configure the environment shared by all tests, and inherited by pytest-xdist workers
+    (which are started after this hook has run in the controlling process):
+
+    - when tests are distributed over workers, limit each worker to a single OpenMP/BLAS thread
+      to avoid oversubscribing cores.
+    - use the non-interactive Agg backend whenever matplotlib is imported, without importing it
+      here for test sessions which do not plot.
+    """
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    if getattr(config.option, 'numprocesses', None):
+        for var in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ.setdefault(var, '1')
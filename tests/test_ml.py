@@ -1,20 +1,21 @@
-import json
+import gzip
 import os
+import shutil
 from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import pytest
 import numpy as np
-import matplotlib as mpl
-mpl.use('Agg')
+from scipy.sparse import isspmatrix_csr
 
 from tests.targets import cv_scores_trex
 from phenotrex.io.flat import (
-    load_training_files, write_weights_file, write_params_file, write_misclassifications_file,
-    write_cccv_accuracy_file, write_genotype_file
+    load_training_files, load_genotype_file, write_weights_file, write_params_file,
+    write_misclassifications_file, write_cccv_accuracy_file, write_genotype_file
 )
 from phenotrex.io.serialization import save_classifier, load_classifier
 from phenotrex.ml import TrexSVM, TrexXGB
+from phenotrex.ml.clf.xgbm import _gpu_requested
 from phenotrex.util.helpers import get_x_y_tn_ft
 from phenotrex.ml.feature_select import recursive_feature_elimination
 from phenotrex.ml.prediction import predict
@@ -49,55 +50,101 @@ scoring_methods = [
 
 predict_files = [
     (GENOMIC_PATH/'GCA_000692775_1_trunc2.fna.gz', ),
-    (GENOMIC_PATH/'GCA_000692775_1_trunc2.faa.gz', ),
     (GENOMIC_PATH/'GCA_000692775_1_trunc2.fna.gz', GENOMIC_PATH/'GCA_000692775_1_trunc2.faa.gz')
 ]
 
 
-class TestTrexClassifier:
-    @staticmethod
-    def _round_nested_dict(d, decimal=1):
-        return json.loads(json.dumps(d), parse_float=lambda x: round(float(x), decimal))
+@pytest.fixture(scope='session', params=trait_names, ids=trait_names)
+def trait_name(request):
+    return request.param
+
+
+@pytest.fixture(scope='session')
+def training_data(trait_name):
+    """
+    Load the training files of the given trait once per test session.
+
+    :return: training_records, genotype, phenotype, group
+    """
+    return load_training_files(
+        genotype_file=FLAT_PATH/trait_name/f"{trait_name}.genotype",
+        phenotype_file=FLAT_PATH/trait_name/f"{trait_name}.phenotype",
+        groups_file=FLAT_PATH/trait_name/f"{trait_name}.taxids",
+        verb=True
+    )
+
+
+@pytest.fixture(scope='module', params=classifiers, ids=classifier_ids)
+def classifier(request):
+    return request.param
+
+
+@pytest.fixture(scope='module')
+def trained_classifier(classifier, training_data):
+    """
+    Train the given classifier type on the training data once per module.
+    Training is seeded, so the fitted classifier can be shared between tests.
+    All tests using it (directly or through `model`) are in the xdist group 'trained',
+    so that it is trained on a single pytest-xdist worker only.
+
+    :return: the fitted classifier
+    """
+    training_records, genotype, phenotype, group = training_data
+    clf = classifier(verb=True, random_state=RANDOM_STATE)
+    clf.train(records=training_records)
+    return clf
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("do_write", [True, ])
-    def test_load_data(self, trait_name, do_write):
+
+@pytest.fixture(scope='module')
+def model(trait_name, classifier, request):
+    """
+    Return a fitted classifier of the given type and trait for prediction, loaded once per module.
+    Uses the stored model if it is at least as recent as the trait's genotype file,
+    and otherwise the shared trained classifier.
+
+    :return: the fitted classifier
+    """
+    stored_path = MODELS_PATH/trait_name/f'{trait_name}.{classifier.identifier.lower()}.pkl'
+    genotype_file = FLAT_PATH/trait_name/f'{trait_name}.genotype'
+    if stored_path.is_file() and stored_path.stat().st_mtime >= genotype_file.stat().st_mtime:
+        return load_classifier(stored_path)
+    return request.getfixturevalue('trained_classifier')
+
+
+class TestTrexClassifier:
+    def test_load_data(self, training_data):
         """
-        Test training data loading. Check/catch invalid file formats.
-        :param trait_name:
+        Test training data loading and writing of the loaded genotypes.
+        :param training_data:
         :return:
         """
-        full_path_genotype = FLAT_PATH/trait_name/f"{trait_name}.genotype"
-        full_path_phenotype = FLAT_PATH/trait_name/f"{trait_name}.phenotype"
-        full_path_groups = FLAT_PATH/trait_name/f"{trait_name}.taxids"
-        training_records, genotype, phenotype, group = load_training_files(
-            genotype_file=full_path_genotype,
-            phenotype_file=full_path_phenotype,
-            groups_file=full_path_groups,
-            verb=True
-        )
-        if do_write:
-            with TemporaryDirectory() as tmpdir:
-                gt_out = Path(tmpdir)/'gt.genotype'
-                write_genotype_file(genotype, gt_out)
-                assert gt_out.is_file()
-        return training_records, genotype, phenotype, group
-
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
-    @pytest.mark.parametrize("use_shaps", [True, False], ids=['shap', 'noshap'])
-    def test_train(self, trait_name, classifier, use_shaps):
+        training_records, genotype, phenotype, group = training_data
+        assert len(training_records) > 0
+        with TemporaryDirectory() as tmpdir:
+            gt_out = Path(tmpdir)/'gt.genotype'
+            write_genotype_file(genotype, gt_out)
+            assert gt_out.is_file()
+
+            # reading back a gzipped genotype file must give the same records
+            gt_gz = Path(tmpdir)/'gt.genotype.gz'
+            with open(gt_out, 'rb') as fin, gzip.open(gt_gz, 'wb') as fout:
+                shutil.copyfileobj(fin, fout)
+            assert load_genotype_file(gt_gz) == load_genotype_file(gt_out) == genotype
+
+    def test_train(self, training_data, classifier):
         """
         Test TrexClassifier training. Using different traits.
-        :param trait_name:
+        Trains once without an explainer, then fits the explainer on the trained model.
+        :param training_data:
         :param classifier:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
+        training_records, genotype, phenotype, group = training_data
         clf = classifier(verb=True, random_state=RANDOM_STATE)
-        clf.train(records=training_records, train_explainer=use_shaps)
+        clf.train(records=training_records, train_explainer=False)
         with TemporaryDirectory() as tmpdir:
             clf_path = Path(tmpdir)/'classifier.pkl'
+            clf_shap_path = Path(tmpdir)/'classifier_shap.pkl'
             weights_path = Path(tmpdir)/'weights.rank'
             save_classifier(clf,  clf_path)
             weights = clf.get_feature_weights()
@@ -105,23 +152,40 @@ class TestTrexClassifier:
             assert clf_path.is_file()
             assert weights_path.is_file()
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
+            clf.fit_explainer(training_records)
+            save_classifier(clf, clf_shap_path)
+            assert clf_shap_path.is_file()
+            assert clf.get_feature_weights() == weights
+
+    @pytest.mark.gpu
+    @pytest.mark.skipif(not _gpu_requested(), reason='GPU training not requested by XGB_USE_GPU')
+    def test_train_xgb_gpu(self, training_data):
+        """
+        Test TrexXGB training on the GPU.
+        :param training_data:
+        :return:
+        """
+        training_records, genotype, phenotype, group = training_data
+        clf = TrexXGB(verb=True, random_state=RANDOM_STATE)
+        assert clf.pipeline.named_steps['clf'].tree_method == 'gpu_hist'
+        clf.train(records=training_records)
+        assert len(clf.get_feature_weights()) > 0
+
     @pytest.mark.parametrize("cv", cv_folds, ids=[str(x) for x in cv_folds])
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
     @pytest.mark.parametrize("use_groups", [True, False], ids=['logo', 'nologo'])
-    def test_crossvalidate(self, trait_name, cv, classifier, use_groups):
+    def test_crossvalidate(self, trait_name, training_data, cv, classifier, use_groups):
         """
         Test default crossvalidation of TrexClassifier class.
         Using several different traits, cv folds, and scoring methods.
         Compares with dictionary cv_scores.
 
-        :param trait_name:
+        :param training_data:
         :param cv:
         :param classifier:
         :param use_groups:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
+        training_records, genotype, phenotype, group = training_data
         clf = classifier(verb=True, random_state=RANDOM_STATE)
         score_pred, missclassfcs = clf.crossvalidate(
             records=training_records,
@@ -132,8 +196,13 @@ class TestTrexClassifier:
         )
         if classifier.identifier in cv_scores_trex and not use_groups:
             score_target = cv_scores_trex[classifier.identifier][trait_name][cv]
-            for stat in score_target.keys():
-                np.testing.assert_almost_equal(actual=score_pred[stat], desired=score_target[stat], decimal=1)
+            stats = list(score_target.keys())
+            # same tolerance as assert_almost_equal(decimal=1), checked for all stats at once
+            np.testing.assert_allclose(
+                actual=np.array([score_pred[stat] for stat in stats]),
+                desired=np.array([score_target[stat] for stat in stats]),
+                rtol=0, atol=1.5e-1, err_msg=f'rows: {stats}'
+            )
         with TemporaryDirectory() as tmpdir:
             misclass_path = Path(tmpdir)/'misclassifications.tsv'
             write_misclassifications_file(
@@ -141,21 +210,43 @@ class TestTrexClassifier:
             )
             assert misclass_path.is_file()
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
-    def test_parameter_search(self, trait_name, classifier):
+    def test_crossvalidate_parallel_folds(self, training_data, classifier):
+        """
+        Folds evaluated in parallel must give the same result as a serial reference.
+
+        :param training_data:
+        :param classifier:
+        :return:
+        """
+        training_records, genotype, phenotype, group = training_data
+        results = []
+        for n_jobs in (1, 2):
+            clf = classifier(verb=False, random_state=RANDOM_STATE)
+            results.append(clf.crossvalidate(
+                records=training_records,
+                cv=3,
+                n_replicates=2,
+                n_jobs=n_jobs
+            ))
+        (scores_serial, misclass_serial), (scores_parallel, misclass_parallel) = results
+        for stat in scores_serial.keys():
+            np.testing.assert_allclose(scores_parallel[stat], scores_serial[stat])
+        np.testing.assert_array_equal(misclass_parallel, misclass_serial)
+
+    @pytest.mark.slow
+    def test_parameter_search(self, training_data, classifier):
         """
-        Test randomized parameter search.
+        Test randomized parameter search. Uses fewer iterations on CI.
 
-        :param trait_name:
+        :param training_data:
         :param classifier:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
+        training_records, genotype, phenotype, group = training_data
         clf = classifier(verb=True, random_state=RANDOM_STATE)
         clf_opt = clf.parameter_search(
             records=training_records,
-            n_iter=3,
+            n_iter=2 if os.environ.get('CI') else 3,
             return_optimized=False,
             n_jobs=min(4, os.cpu_count())
         )
@@ -165,16 +256,15 @@ class TestTrexClassifier:
             write_params_file(param_path, clf_opt)
             assert param_path.is_file()
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
-    def test_compleconta_cv(self, trait_name, classifier):
+    @pytest.mark.xdist_group(name='cccv')
+    def test_compleconta_cv(self, training_data, classifier):
         """
         Perform compleconta-cv for each trait name using TrexClassifier class.
-        :param trait_name:
+        :param training_data:
         :param classifier:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
+        training_records, genotype, phenotype, group = training_data
         clf = classifier(verb=True, random_state=RANDOM_STATE)
         cccv_scores = clf.crossvalidate_cc(
             records=training_records,
@@ -189,52 +279,62 @@ class TestTrexClassifier:
             write_cccv_accuracy_file(fp, cccv_results=cccv_scores)
             assert fp.is_file()
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
-    def test_get_feature_names(self, trait_name, classifier):
+    @pytest.mark.xdist_group(name='trained')
+    def test_get_feature_names(self, trained_classifier):
         """
         Get feature names of classifier.
 
-        :param trait_name:
-        :param classifier:
+        :param trained_classifier:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
-        clf = classifier(verb=True, random_state=RANDOM_STATE)
-        clf.train(training_records)
-        fweights = clf.get_feature_weights()
+        fweights = trained_classifier.get_feature_weights()
         print(fweights)
         print(len(fweights))
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
-    @pytest.mark.parametrize("classifier", classifiers, ids=classifier_ids)
-    def test_get_shap_values(self, trait_name, classifier):
+    @pytest.mark.xdist_group(name='trained')
+    def test_get_shap_values(self, training_data, trained_classifier):
         """
         Get shap values associated with the training data.
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
-        clf = classifier(verb=True, random_state=RANDOM_STATE)
-        clf.train(training_records)
+        training_records, genotype, phenotype, group = training_data
         # n_samples only used by TrexSVM; reduced number of samples due to TrexSVM
-        raw_features, shaps, bias = clf.get_shap(training_records[:5], n_samples=50)
+        raw_features, shaps, bias = trained_classifier.get_shap(training_records[:5], n_samples=50)
         print(shaps.shape)
         print(bias)
 
-    @pytest.mark.parametrize("trait_name", trait_names, ids=trait_names)
+    @pytest.mark.xdist_group(name='trained')
+    @pytest.mark.parametrize('classifier', [TrexSVM], ids=['SVM'], indirect=True)
+    def test_svm_linear_explainer(self, training_data, trained_classifier):
+        """
+        SHAP values of the LinearExplainer of TrexSVM must add up to the mean log-odds
+        of the sigmoid-calibrated LinearSVCs.
+        """
+        training_records, genotype, phenotype, group = training_data
+        raw_features, shaps, bias = trained_classifier.get_shap(training_records)
+        calibrated = trained_classifier.pipeline.named_steps['clf'].calibrated_classifiers_
+        mean_log_odds = np.mean([
+            -(c.calibrators_[0].a_ * c.base_estimator.decision_function(raw_features)
+              + c.calibrators_[0].b_)
+            for c in calibrated
+        ], axis=0)
+        np.testing.assert_allclose(shaps.sum(axis=1) + bias, mean_log_odds, rtol=1e-6, atol=1e-6)
+
+    @pytest.mark.xdist_group(name='rfe')
     @pytest.mark.parametrize("n_features", [10_000])
-    def test_recursive_feature_elimination(self, trait_name, n_features):
+    def test_recursive_feature_elimination(self, training_data, n_features):
         """
         Perform feature compression tests only for SVM; counterindicated for XGB.
-        :param trait_name:
+        :param training_data:
         :return:
         """
-        training_records, genotype, phenotype, group = self.test_load_data(trait_name, False)
+        training_records, genotype, phenotype, group = training_data
         svm = TrexSVM(verb=True, random_state=RANDOM_STATE)
         recursive_feature_elimination(
             records=training_records,
             pipeline=svm.cv_pipeline,
             step=0.01,
             n_features=n_features,
+            n_jobs=2,  # bounded, as tests may already run in parallel pytest-xdist workers
         )
         vec = svm.cv_pipeline.named_steps["vec"]
         vec._validate_vocabulary()
@@ -248,41 +348,35 @@ class TestTrexClassifier:
         X, y, tn, ft = get_x_y_tn_ft(training_records)
         X_trans = vec.transform(X)
 
+        # check that features stay sparse and binary; memory must scale with nnz only
+        assert isspmatrix_csr(X_trans)
+        assert X_trans.dtype == np.bool_
+
         # check if number of unique features is matching
         assert X_trans.shape[1] >= n_features
 
         # check if all samples still have at least one feature present
-        one_is_zero = False
-        non_zero = X_trans.nonzero()
-        for x in non_zero:
-            if len(x) == 0:
-                one_is_zero = True
-        assert not one_is_zero
-
-    @pytest.mark.parametrize('trait_name', trait_names, ids=trait_names)
-    @pytest.mark.parametrize('classifier_type', classifier_ids, ids=classifier_ids)
-    def test_predict_from_genotype(self, trait_name, classifier_type):
-        model_path = MODELS_PATH/trait_name/f'{trait_name}.{classifier_type.lower()}.pkl'
+        assert X_trans.getnnz(axis=1).min() > 0
+
+    @pytest.mark.xdist_group(name='trained')
+    def test_predict_from_genotype(self, trait_name, model):
         genotype_file = FLAT_PATH/trait_name/f'{trait_name}.genotype'
-        print(predict(classifier=model_path, genotype=genotype_file))
+        print(predict(classifier=model, genotype=genotype_file))
 
+    @pytest.mark.xdist_group(name='trained')
     @pytest.mark.skipif(not FROM_FASTA, reason='Missing optional dependencies')
-    @pytest.mark.parametrize('trait_name', trait_names, ids=trait_names)
-    @pytest.mark.parametrize('fasta_files', predict_files, ids=['fna', 'faa', 'fna+faa'])
-    @pytest.mark.parametrize('classifier_type', classifier_ids, ids=classifier_ids)
-    def test_predict_from_fasta(self, trait_name, classifier_type, fasta_files):
-        model_path = MODELS_PATH/trait_name/f'{trait_name}.{classifier_type.lower()}.pkl'
+    @pytest.mark.parametrize('fasta_files', predict_files, ids=['fna', 'fna+faa'])
+    def test_predict_from_fasta(self, classifier, model, fasta_files):
+        # all FASTA files of a call are annotated and predicted in a single batch
         with TemporaryDirectory() as tmpdir:
-            tmp_path = Path(tmpdir)/'model.pkl'
-            summary_path = Path(tmpdir)/'summary.tsv' if classifier_type == 'XGB' else None
-            per_sample_path = Path(tmpdir)/'per_sample.tsv' if classifier_type == 'XGB' else None
-            clf = load_classifier(model_path)
-            save_classifier(clf, tmp_path)
+            summary_path = Path(tmpdir)/'summary.tsv' if classifier.identifier == 'XGB' else None
+            per_sample_path = Path(tmpdir)/'per_sample.tsv' if classifier.identifier == 'XGB' else None
             pred = predict(
-                fasta_files=fasta_files, classifier=tmp_path,
+                fasta_files=fasta_files, classifier=model,
                 out_explain_summary=summary_path,
                 out_explain_per_sample=per_sample_path
             )
             assert summary_path is None or summary_path.is_file()
             assert per_sample_path is None or per_sample_path.is_file()
+            assert len(pred) == len(fasta_files)
             print(pred)
@@ -2,6 +2,8 @@ from tempfile import TemporaryDirectory
 from pathlib import Path
 
 import pytest
+import numpy as np
+import scipy.sparse as sp
 import matplotlib as mpl
 
 mpl.use('Agg')
@@ -9,7 +11,7 @@ import matplotlib.pyplot as plt
 
 from phenotrex.io.flat import load_training_files
 from phenotrex.io.serialization import load_classifier
-from phenotrex.ml.shap_handler import ShapHandler
+from phenotrex.ml.shap_handler import ShapHandler, _get_present_absent_kernel, _present_absent_sums
 from . import MODELS_PATH, FLAT_PATH
 
 
@@ -95,3 +97,76 @@ class TestShapHandler:
             sf = sh.get_shap_force(sample_name=record.identifier)
             print(sf)
             assert len(sf)
+
+    def test_present_absent_kernel(self):
+        """
+        The numba kernel must give the same sums and counts as the NumPy implementation,
+        including for features absent from and present in all samples.
+        """
+        pytest.importorskip('numba')
+        rng = np.random.RandomState(0)
+        mask = rng.rand(50, 8) < 0.3
+        mask[:, 0] = False  # absent in all samples
+        mask[:, 1] = True  # present in all samples
+        present = sp.csc_matrix(mask)
+        shaps = rng.randn(50, 8).astype(np.float32)
+
+        kernel = _get_present_absent_kernel()
+        assert kernel is not None
+        from_kernel = kernel(present.indptr, present.indices, np.asfortranarray(shaps))
+        from_numpy = _present_absent_sums(present, shaps)  # few samples, so not using numba
+        for k, n in zip(from_kernel, from_numpy):
+            np.testing.assert_allclose(k, n, rtol=1e-5, atol=1e-6)
+        sum_p, cnt_p, sum_a, cnt_a = from_kernel
+        np.testing.assert_array_equal(cnt_p, mask.sum(axis=0))
+        np.testing.assert_array_equal(cnt_a, (~mask).sum(axis=0))
+        assert sum_p[0] == 0 and sum_a[1] == 0
+
+    def test_get_shap_summary_values(self):
+        """
+        Check SHAP summary statistics against hand-computed values, with feature data
+        added in two chunks and one feature which is present in no sample.
+        """
+        sh = ShapHandler(feature_names=np.array(['a', 'b', 'c']), used_idxs=np.array([0, 1, 2]))
+        sh.add_feature_data(
+            sample_names=np.array(['s1', 's2']),
+            features=np.array([[1, 0, 0], [1, 1, 0]]),
+            shaps=np.array([[1., -2., .5], [3., 4., -.5]]),
+            base_value=0.
+        )
+        sh.add_feature_data(
+            sample_names=np.array(['s3']),
+            features=np.array([[0, 1, 0]]),
+            shaps=np.array([[-1., 2., .25]]),
+            base_value=0.
+        )
+        ss = sh.get_shap_summary(n_max_features=None)
+        # sorted by sum of absolute SHAP values: b (8), a (5), c (1.25)
+        assert list(ss['Feature']) == ['b', 'a', 'c']
+        np.testing.assert_allclose(ss['Mean SHAP If Present'], [3., 2., np.nan])
+        np.testing.assert_allclose(ss['Mean SHAP If Absent'], [-2., -1., 0.08333])
+        np.testing.assert_array_equal(ss['N(present)'], [2, 2, 0])
+        np.testing.assert_array_equal(ss['N(absent)'], [1, 1, 3])
+
+    def test_get_shap_force_ties(self):
+        """
+        Features with tied SHAP values must be ordered the same whether or not the number
+        of returned features is limited.
+        """
+        rng = np.random.RandomState(0)
+        n_features = 60
+        sh = ShapHandler(feature_names=np.array([f'f{j}' for j in range(n_features)]),
+                         used_idxs=np.arange(n_features))
+        sh.add_feature_data(
+            sample_names=np.array(['s1', 's2']),
+            features=rng.rand(2, n_features) < 0.5,
+            shaps=rng.randint(-2, 3, size=(2, n_features)).astype(float),  # many ties
+            base_value=0.
+        )
+        for sample_name in ('s1', 's2'):
+            top = sh.get_shap_force(sample_name, n_max_features=20)
+            full = sh.get_shap_force(sample_name, n_max_features=None)
+            assert list(top['Feature']) == list(full['Feature'][:20])
+        top = sh.get_shap_summary(n_max_features=20)
+        full = sh.get_shap_summary(n_max_features=None)
+        assert list(top['Feature']) == list(full['Feature'][:20])
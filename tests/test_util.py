@@ -1,8 +1,11 @@
+import os
+import shutil
 from pathlib import Path
 
 import pytest
 from tempfile import TemporaryDirectory
 from phenotrex.cli.generic_func import generic_compute_shaps
+from phenotrex.io import flat
 from phenotrex.io.flat import load_training_files
 from phenotrex.util.plotting import compleconta_plot, shap_summary_plot, shap_force_plots
 from phenotrex.ml.clf.xgbm import TrexXGB
@@ -84,5 +87,43 @@ class TestUtil:
         preds = xgb.predict(td)
         assert preds is not None
 
+    def test_training_files_cache(self, monkeypatch, tmp_path):
+        """
+        With PHENOTREX_CACHE set, unchanged training files are parsed only once,
+        while touching or editing the genotype file forces them to be parsed again.
+        """
+        genotype_file = tmp_path/f'{trait_name}.genotype'
+        phenotype_file = tmp_path/f'{trait_name}.phenotype'
+        shutil.copy(FLAT_PATH/trait_name/genotype_file.name, genotype_file)
+        shutil.copy(FLAT_PATH/trait_name/phenotype_file.name, phenotype_file)
+        monkeypatch.setenv(flat.CACHE_DIR_ENV_VAR, str(tmp_path/'cache'))
+        n_parsed = []
+        parse = flat._load_training_files
+
+        def counting_parse(*args, **kwargs):
+            n_parsed.append(1)
+            return parse(*args, **kwargs)
+
+        monkeypatch.setattr(flat, '_load_training_files', counting_parse)
+
+        first = load_training_files(genotype_file, phenotype_file)
+        second = load_training_files(genotype_file, phenotype_file)
+        assert len(n_parsed) == 1
+        assert second == first
+
+        stat = genotype_file.stat()
+        os.utime(genotype_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        assert load_training_files(genotype_file, phenotype_file) == first
+        assert len(n_parsed) == 2
+
+        lines = genotype_file.read_text().splitlines()
+        edited_idx = next(i for i, line in enumerate(lines) if not line.startswith('#'))
+        lines[edited_idx] += '\tNEW_FEATURE'
+        genotype_file.write_text('\n'.join(lines) + '\n')
+        _, gr, _, _ = load_training_files(genotype_file, phenotype_file)
+        assert len(n_parsed) == 3
+        edited_id = lines[edited_idx].split('\t', maxsplit=1)[0]
+        assert 'NEW_FEATURE' in next(x.features for x in gr if x.identifier == edited_id)
+
     def test_download_eggnog5_annot(self):
         assert Eggnog5TextAnnotator().annotate(2, 'COG3520')